@@ -2,11 +2,18 @@
 import os
 import logging
 import time
-from typing import List, Dict, Tuple, Optional, Any
-from datetime import datetime
+import asyncio
+import json
+import re
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional, Any, Callable
+import aiofiles
+import httpx
 import openai
 from dotenv import load_dotenv
 from metrics.collector import MetricsCollector
+from metrics.cache import ResponseCache
+from metrics.dispatcher import RateLimitedDispatcher, get_encoding_for_model
 
 # Configure logging
 logging.basicConfig(
@@ -18,21 +25,97 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Memory layer files indexed by layer number (index 0 unused)
+LAYER_PATHS = (
+    None,
+    "memory/layer_1_logic.md",
+    "memory/layer_2_concepts.md",
+    "memory/layer_3_important_details.md",
+    "memory/layer_4_arbitrary.md",
+)
+
+# Queries mentioning any of these pull in layer 4 (arbitrary details)
+LAYER4_RE = re.compile(r"legacy|old version|deprecated|edge case", re.IGNORECASE)
+
+# Prompt and memory files rarely change within a session, so keep recent
+# contents in memory keyed by (path, mtime) and only re-read edited files
+TEXT_CACHE_SIZE = 32
+_text_cache: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+
+async def load_text_file(file_path: str) -> str:
+    """Load content from a text file, reusing cached content while its mtime is unchanged."""
+    try:
+        key = (file_path, os.stat(file_path).st_mtime_ns)
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+            content = await f.read()
+    except FileNotFoundError:
+        logger.warning(f"File not found: {file_path}")
+        return ""
+    except Exception as e:
+        logger.error(f"Error reading file {file_path}: {e}")
+        return ""
+
+    _text_cache[key] = content
+    if len(_text_cache) > TEXT_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return content
+
+def _split_evenly(total: int, parts: int) -> List[int]:
+    """Split an integer total into `parts` near-equal shares that sum to it."""
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
 class CodingAgent:
-    def __init__(self, model: str = "gpt-4"):
+    def __init__(
+        self,
+        model: str = "gpt-4",
+        max_requests_per_minute: float = 500,
+        max_tokens_per_minute: float = 30000,
+        temperature: float = 0.3,
+        cache_responses: bool = True,
+        on_token: Optional[Callable[[str, str], None]] = None
+    ):
         """
         Initialize the coding agent with interactive reflection capabilities.
         
         Args:
             model: The OpenAI model to use
+            max_requests_per_minute: Request rate limit enforced client-side
+            max_tokens_per_minute: Token rate limit enforced client-side
+            temperature: Sampling temperature for all completions
+            cache_responses: Reuse stored completions for identical requests
+            on_token: Called with (context_type, text) as each completion streams in
         """
         self.model = model
+        self.temperature = temperature
+        self.on_token = on_token
+        # Loaded on first use since reading it is async
+        self._system_prompt = ""
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OpenAI API key not found in environment variables")
             
         # Initialize OpenAI client
-        self.client = openai.OpenAI(api_key=self.api_key)
+        # HTTP/2 with a keep-alive pool so calls reuse one TLS connection
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=200,
+                max_keepalive_connections=100,
+                keepalive_expiry=60.0
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+        # Retries are handled by the dispatcher, so the SDK's own retries are disabled
+        self.client = openai.AsyncOpenAI(api_key=self.api_key, http_client=self._http, max_retries=0)
+        self.dispatcher = RateLimitedDispatcher(
+            self.client,
+            model=model,
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute
+        )
         
         # Initialize metrics collector
         try:
@@ -41,66 +124,98 @@ class CodingAgent:
             logger.warning(f"Failed to initialize metrics collector: {e}")
             self.metrics = None
 
-    def load_text_file(self, file_path: str) -> str:
-        """Load content from a text file."""
-        try:
-            if not os.path.exists(file_path):
-                logger.warning(f"File not found: {file_path}")
-                return ""
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except Exception as e:
-            logger.error(f"Error reading file {file_path}: {e}")
-            return ""
+        # Initialize response cache
+        self.cache = None
+        if cache_responses:
+            try:
+                self.cache = ResponseCache()
+            except Exception as e:
+                logger.warning(f"Failed to initialize response cache: {e}")
 
-    def gather_memory(self, layers_needed: List[int]) -> str:
+    async def gather_memory(self, layers_needed: List[int]) -> str:
         """Gather content from memory layers."""
         memory_content = []
-        base_dir = "memory"
-        
-        layer_files = {
-            1: "layer_1_logic.md",
-            2: "layer_2_concepts.md",
-            3: "layer_3_important_details.md",
-            4: "layer_4_arbitrary.md"
-        }
         
-        for layer in layers_needed:
-            if layer in layer_files:
-                if self.metrics:
-                    self.metrics.log_layer_access(layer)
-                content = self.load_text_file(os.path.join(base_dir, layer_files[layer]))
-                if content:
-                    memory_content.append(f"=== Layer {layer} Knowledge ===\n{content}\n")
+        layers = [layer for layer in layers_needed if 1 <= layer < len(LAYER_PATHS)]
+        for layer in layers:
+            if self.metrics:
+                self.metrics.log_layer_access(layer)
+
+        # Read all layers concurrently; gather keeps results in input order
+        contents = await asyncio.gather(*[
+            load_text_file(LAYER_PATHS[layer])
+            for layer in layers
+        ])
+        for layer, content in zip(layers, contents):
+            if content:
+                memory_content.append(f"=== Layer {layer} Knowledge ===\n{content}\n")
         
         return "\n".join(memory_content)
 
-    def get_completion(self, messages: List[Dict[str, str]], context_type: str) -> str:
+    async def get_completion(self, messages: List[Dict[str, str]], context_type: str) -> str:
         """Get completion from OpenAI API with metrics collection."""
+        # Cache failures must never cost a completion, so they only log
+        cache_key = None
+        if self.cache:
+            try:
+                cache_key = self.cache.make_key(self.model, context_type, messages, self.temperature)
+                cached = self.cache.get(cache_key)
+            except Exception as e:
+                logger.warning(f"Response cache lookup failed ({context_type}): {e}")
+                cached = None
+            if cached is not None:
+                logger.info(f"Cache hit ({context_type})")
+                if self.on_token:
+                    self.on_token(context_type, cached)
+                return cached
+
         try:
-            start_time = datetime.now()
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.3
+
+            start_time = time.perf_counter()
+            response = await self.dispatcher.submit(
+                messages,
+                context_type,
+                temperature=self.temperature,
+                stream=True,
+                stream_options={"include_usage": True}
             )
             
-            content = response.choices[0].message.content
+            # Stream tokens to the caller as they arrive; usage comes on the final chunk
+            parts = []
+            usage = None
+            async for chunk in response:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    if self.on_token:
+                        self.on_token(context_type, delta)
             
-            if self.metrics:
-                duration = (datetime.now() - start_time).total_seconds()
+            # Stop the clock before the cache write so latency is the API's alone
+            duration = time.perf_counter() - start_time
+            content = "".join(parts)
+            if self.cache and cache_key and content:
+                try:
+                    self.cache.put(cache_key, context_type, content)
+                except Exception as e:
+                    logger.warning(f"Failed to cache response ({context_type}): {e}")
+            
+            if self.metrics and usage:
                 self.metrics.log_completion(
                     context_type=context_type,
                     duration=duration,
-                    prompt_tokens=response.usage.prompt_tokens,
-                    completion_tokens=response.usage.completion_tokens
+                    prompt_tokens=usage.prompt_tokens,
+                    completion_tokens=usage.completion_tokens
                 )
                 
                 logger.info(f"""
                     API Call Metrics ({context_type}):
-                    Prompt Tokens: {response.usage.prompt_tokens}
-                    Completion Tokens: {response.usage.completion_tokens}
-                    Total Tokens: {response.usage.total_tokens}
+                    Prompt Tokens: {usage.prompt_tokens}
+                    Completion Tokens: {usage.completion_tokens}
+                    Total Tokens: {usage.total_tokens}
                 """)
             
             return content
@@ -109,30 +224,44 @@ class CodingAgent:
             logger.error(f"Error getting completion: {e}")
             return f"Error: {str(e)}"
 
-    def _get_initial_solution(self, user_query: str) -> str:
-        """Generate initial solution."""
-        system_prompt = self.load_text_file("prompts/system_prompt.md")
-        if not system_prompt:
-            raise FileNotFoundError("System prompt file not found")
-
+    def _select_layers(self, user_query: str) -> List[int]:
+        """Pick the memory layers relevant to a query."""
         layers_to_load = [1, 2, 3]
-        if any(keyword in user_query.lower() for keyword in 
-              ['legacy', 'old version', 'deprecated', 'edge case']):
+        if LAYER4_RE.search(user_query):
             layers_to_load.append(4)
+        return layers_to_load
+
+    async def _build_prefix_messages(self, layers: List[int]) -> List[Dict[str, str]]:
+        """
+        Build the system + memory prefix shared by every step of an interaction.
 
-        memory_snippets = self.gather_memory(layers_to_load)
+        The prefix must stay byte-identical across the initial, reflection and
+        refinement calls so the API can reuse its cached prompt prefix; only
+        the trailing user turn may differ between steps.
+        """
+        if not self._system_prompt:
+            self._system_prompt = await load_text_file("prompts/system_prompt.md")
+            if not self._system_prompt:
+                raise FileNotFoundError("System prompt file not found")
+
+        memory_snippets = await self.gather_memory(layers)
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"Relevant memory:\n{memory_snippets}"},
+        return [
+            {"role": "system", "content": self._system_prompt},
+            {"role": "system", "content": f"Relevant memory:\n{memory_snippets}"}
+        ]
+
+    async def _get_initial_solution(self, user_query: str, prefix_messages: List[Dict[str, str]]) -> str:
+        """Generate initial solution."""
+        messages = prefix_messages + [
             {"role": "user", "content": user_query}
         ]
         
-        return self.get_completion(messages, "initial_solution")
+        return await self.get_completion(messages, "initial_solution")
 
-    def _get_reflection(self, solution: str) -> str:
+    async def _get_reflection(self, solution: str, prefix_messages: List[Dict[str, str]]) -> str:
         """Generate reflection analysis."""
-        reflection_prompt = self.load_text_file("prompts/reflection_prompt.md")
+        reflection_prompt = await load_text_file("prompts/reflection_prompt.md")
         if not reflection_prompt:
             logger.warning("Reflection prompt file not found, using fallback")
             reflection_prompt = """
@@ -145,16 +274,29 @@ class CodingAgent:
             Format your response with concrete suggestions and code changes.
             """
         
-        messages = [
-            {"role": "system", "content": "You are a code review assistant providing actionable improvements."},
-            {"role": "user", "content": f"{reflection_prompt}\n\nSolution to analyze:\n{solution}"}
+        messages = prefix_messages + [
+            {"role": "user", "content": (
+                "Act as a code review assistant providing actionable improvements.\n\n"
+                f"{reflection_prompt}\n\nSolution to analyze:\n{solution}"
+            )}
         ]
         
-        return self.get_completion(messages, "reflection")
+        return await self.get_completion(messages, "reflection")
 
-    def refine_solution(self, original_solution: str, reflection_feedback: str, user_query: str) -> str:
+    async def refine_solution(
+        self,
+        original_solution: str,
+        reflection_feedback: str,
+        user_query: str,
+        prefix_messages: Optional[List[Dict[str, str]]] = None
+    ) -> str:
         """Refine the solution based on reflection feedback."""
+        if prefix_messages is None:
+            prefix_messages = await self._build_prefix_messages(self._select_layers(user_query))
+
         refinement_prompt = f"""
+        You are tasked with improving a solution based on detailed feedback.
+
         Original Task: {user_query}
 
         Initial Solution:
@@ -173,23 +315,139 @@ class CodingAgent:
         Ensure the solution maintains readability while implementing all suggested enhancements.
         """
         
-        messages = [
-            {"role": "system", "content": "You are a coding assistant tasked with improving a solution based on detailed feedback."},
+        messages = prefix_messages + [
             {"role": "user", "content": refinement_prompt}
         ]
         
-        return self.get_completion(messages, "refinement")
+        return await self.get_completion(messages, "refinement")
+
+    async def _get_batched_initial_solutions(
+        self,
+        queries: List[str],
+        layers: List[int]
+    ) -> Tuple[List[Optional[str]], List[Optional[Dict[str, Any]]]]:
+        """
+        Generate initial solutions for several queries in a single completion.
+
+        Returns one solution and one completion-metrics share per query.
+        Solutions are None where the batched answer could not be recovered,
+        so the caller can fall back to a single call. The batch's token usage
+        is split evenly across the queries it answered.
+        """
+        tasks = "\n\n".join(
+            f"Task {task_id}:\n{query}" for task_id, query in enumerate(queries, start=1)
+        )
+        batch_prompt = (
+            "Answer each numbered task independently, as if it were the only question asked. "
+            'Reply with only a JSON object of the form {"answers": [{"id": <task number>, "answer": "<full answer>"}]} '
+            "with exactly one entry per task.\n\n"
+            f"{tasks}"
+        )
+
+        # Collect the batch call's metrics without recording it as an interaction
+        if self.metrics:
+            self.metrics.start_interaction()
+        try:
+            prefix_messages = await self._build_prefix_messages(layers)
+            messages = prefix_messages + [
+                {"role": "user", "content": batch_prompt}
+            ]
+            content = await self.get_completion(messages, "initial_solution_batch")
+        finally:
+            interaction = self.metrics.discard_interaction() if self.metrics else None
+
+        solutions: List[Optional[str]] = [None] * len(queries)
+        try:
+            # Not every model supports JSON mode, so tolerate prose or code fences around the object
+            payload = content[content.index("{"):content.rindex("}") + 1]
+            for item in json.loads(payload)["answers"]:
+                task_id = int(item["id"])
+                answer = item["answer"]
+                if 1 <= task_id <= len(queries) and isinstance(answer, str) and answer:
+                    solutions[task_id - 1] = answer
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Could not parse batched initial solutions, falling back to single calls: {e}")
+
+        # Queries without a batched answer pay for their own fallback call instead
+        shares: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        answered = [i for i, solution in enumerate(solutions) if solution is not None]
+        if answered and interaction and interaction['completions']:
+            completion = interaction['completions'][0]
+            prompt_shares = _split_evenly(completion['prompt_tokens'], len(answered))
+            completion_shares = _split_evenly(completion['completion_tokens'], len(answered))
+            for i, prompt_tokens, completion_tokens in zip(answered, prompt_shares, completion_shares):
+                shares[i] = dict(completion, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return solutions, shares
+
+    async def run_agent_batch(self, queries: List[str]) -> List[Tuple[str, str, str]]:
+        """
+        Run the coding agent over several independent queries.
+
+        Queries that load the same memory layers share one initial-solution
+        completion, so the common system+memory prefix is only sent once per
+        group. Reflection and refinement remain individual per query and run
+        concurrently through the dispatcher.
+
+        Args:
+            queries: The user's coding questions or tasks
+
+        Returns:
+            List of (initial_solution, reflection_analysis, improved_solution), in query order
+        """
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for index, query in enumerate(queries):
+            groups.setdefault(tuple(self._select_layers(query)), []).append(index)
+        batched_groups = [indices for indices in groups.values() if len(indices) >= 2]
+
+        for indices in batched_groups:
+            logger.info(f"Generating {len(indices)} initial solutions in one request...")
+        batches = await asyncio.gather(*[
+            self._get_batched_initial_solutions(
+                [queries[i] for i in indices], self._select_layers(queries[indices[0]])
+            )
+            for indices in batched_groups
+        ])
+
+        initial_solutions: List[Optional[str]] = [None] * len(queries)
+        initial_completions: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        for indices, (solutions, shares) in zip(batched_groups, batches):
+            for index, solution, share in zip(indices, solutions, shares):
+                initial_solutions[index] = solution
+                initial_completions[index] = share
+
+        return list(await asyncio.gather(*[
+            self._run_pipeline(query, solution, completion)
+            for query, solution, completion in zip(queries, initial_solutions, initial_completions)
+        ]))
 
-    def run_agent_with_reflection(self, user_query: str) -> Tuple[str, str, str]:
+    async def run_agent_with_reflection(self, user_query: str) -> Tuple[str, str, str]:
         """
         Run the coding agent with interactive reflection and refinement.
 
+        Safe to run concurrently on one agent (e.g. with asyncio.gather); each
+        call records its own metrics interaction.
+
         Args:
             user_query: The user's coding question or task
 
         Returns:
             Tuple of (initial_solution, reflection_analysis, improved_solution)
         """
+        return await self._run_pipeline(user_query)
+
+    async def _run_pipeline(
+        self,
+        user_query: str,
+        precomputed_solution: Optional[str] = None,
+        precomputed_completion: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, str, str]:
+        """
+        Run the initial -> reflection -> refinement steps for one query.
+
+        precomputed_solution skips the initial step (e.g. when a batched
+        request already answered it); precomputed_completion is this query's
+        share of that request's metrics and is recorded with the interaction.
+        """
         accessed_layers = set()  # Track accessed layers
         initial_solution = ""
         reflection = ""
@@ -198,28 +456,36 @@ class CodingAgent:
         try:
             if self.metrics:
                 self.metrics.start_interaction()
+                if precomputed_completion:
+                    self.metrics.log_completion(**precomputed_completion)
             
+            # Every step shares this prefix so its prompt tokens are cached server-side
+            prefix_messages = await self._build_prefix_messages(self._select_layers(user_query))
+
             # Generate initial solution
-            logger.info("Generating initial solution...")
-            initial_solution = self._get_initial_solution(user_query)
+            if precomputed_solution:
+                initial_solution = precomputed_solution
+            else:
+                logger.info("Generating initial solution...")
+                initial_solution = await self._get_initial_solution(user_query, prefix_messages)
             if not initial_solution.startswith("Error"):
                 # Only proceed with reflection if initial solution succeeded
                 logger.info("Performing reflection analysis...")
-                reflection = self._get_reflection(initial_solution)
+                reflection = await self._get_reflection(initial_solution, prefix_messages)
                 
                 if not reflection.startswith("Error"):
                     # Only proceed with refinement if reflection succeeded
                     logger.info("Refining solution based on reflection...")
-                    improved_solution = self.refine_solution(
-                        initial_solution, reflection, user_query
+                    improved_solution = await self.refine_solution(
+                        initial_solution, reflection, user_query, prefix_messages
                     )
             
-            # Track which layers were accessed during the process
-            accessed_layers = getattr(self.metrics, 'current_interaction', {}).get('layer_access', set())
-            
             # Attempt to record metrics, but don't let metrics failure affect the response
             if self.metrics:
                 try:
+                    # Track which layers were accessed during the process
+                    interaction = self.metrics.current_interaction or {}
+                    accessed_layers = interaction.get('layer_access', set())
                     self.metrics.end_interaction(
                         prompt=user_query,
                         solution=improved_solution or initial_solution,
@@ -236,7 +502,7 @@ class CodingAgent:
             )
                 
         except Exception as e:
-            logger.error(f"Error in run_agent_with_reflection: {e}")
+            logger.error(f"Error in _run_pipeline: {e}")
             return (
                 initial_solution or f"Error: {str(e)}",
                 reflection or "Reflection failed.",
@@ -249,10 +515,56 @@ class CodingAgent:
             return self.metrics.get_summary()
         return {}
 
-def main():
-    """Main function to run the agent interactively."""
+    async def __aenter__(self) -> "CodingAgent":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """Stop the dispatcher and release HTTP and database connections."""
+        await self.dispatcher.aclose()
+        await self.client.close()
+        if self.cache:
+            self.cache.close()
+        if self.metrics:
+            self.metrics.close()
+
+# Interactive output sections, keyed by completion context type
+SECTION_TITLES = {
+    "initial_solution": "Initial Solution",
+    "reflection": "Reflection Analysis",
+    "refinement": "Improved Solution",
+}
+
+async def run_interactive():
+    """Run the interactive loop on a single event loop."""
+    streamed_sections: List[str] = []
+
+    def print_token(context_type: str, text: str):
+        """Print streamed text, opening a new section when the step changes."""
+        if context_type not in SECTION_TITLES:
+            return
+        if not streamed_sections or streamed_sections[-1] != context_type:
+            if streamed_sections:
+                print()
+            streamed_sections.append(context_type)
+            print(f"\n=== {SECTION_TITLES[context_type]} ===")
+        print(text, end="", flush=True)
+
+    try:
+        agent = CodingAgent(on_token=print_token)
+        # Load the tokenizer now rather than on the first query
+        try:
+            get_encoding_for_model(agent.model)
+        except Exception as e:
+            logger.warning(f"Could not preload tokenizer: {e}")
+    except Exception as e:
+        logger.error(f"Fatal error in main: {e}")
+        print(f"Fatal error: {str(e)}")
+        return
+
     try:
-        agent = CodingAgent()
         print("=== Coding Agent with Interactive Reflection ===")
         print("Enter your coding questions (type 'exit' or press Ctrl+C to quit)")
         print("Example: 'How do I implement a binary search tree in Python?'")
@@ -265,16 +577,22 @@ def main():
                     break
                 
                 print("\nProcessing your request...")
-                initial_solution, reflection, improved_solution = agent.run_agent_with_reflection(user_input)
-                
-                print("\n=== Initial Solution ===")
-                print(initial_solution)
+                streamed_sections.clear()
+                results = await agent.run_agent_with_reflection(user_input)
+                print()
                 
-                print("\n=== Reflection Analysis ===")
-                print(reflection)
-                
-                print("\n=== Improved Solution ===")
-                print(improved_solution)
+                # Streaming only shows text as it arrives; a step that failed partway
+                # returns "Error: ..." and must still be reported. Show failed steps
+                # and anything that was never streamed (skipped steps, fallbacks)
+                for context_type, text in zip(SECTION_TITLES, results):
+                    failed = text.startswith("Error")
+                    if context_type in streamed_sections and not failed:
+                        continue
+                    title = SECTION_TITLES[context_type]
+                    if context_type in streamed_sections:
+                        title += " (failed)"
+                    print(f"\n=== {title} ===")
+                    print(text)
                 
                 # Display metrics if available
                 metrics = agent.get_metrics_summary()
@@ -297,6 +615,15 @@ def main():
     except Exception as e:
         logger.error(f"Fatal error in main: {e}")
         print(f"Fatal error: {str(e)}")
+    finally:
+        await agent.aclose()
+
+def main():
+    """Main function to run the agent interactively."""
+    try:
+        asyncio.run(run_interactive())
+    except KeyboardInterrupt:
+        print("\nExiting...")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
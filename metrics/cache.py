@@ -0,0 +1,83 @@
+# metrics/cache.py
+import sqlite3
+import threading
+import time
+import json
+import hashlib
+from typing import Dict, List, Optional
+
+class ResponseCache:
+    def __init__(self, db_path: str = "metrics.db", max_rows: int = 1000):
+        """Initialize an exact-match completion cache with SQLite storage."""
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_db()
+
+    def _init_db(self):
+        """Initialize the cache table."""
+        with self._lock:
+            conn = self._conn
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key BLOB PRIMARY KEY,
+                    context_type TEXT,
+                    content TEXT,
+                    created REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON cache(created)")
+
+    @staticmethod
+    def make_key(model: str, context_type: str, messages: List[Dict[str, str]],
+                 temperature: float) -> bytes:
+        """Hash the model, context, sampling temperature and messages into a cache key."""
+        canonical = json.dumps(messages, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        h = hashlib.blake2b(digest_size=32)
+        for part in (model, context_type, repr(temperature), canonical):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        """Return the cached content for a key, refreshing its recency."""
+        with self._lock:
+            conn = self._conn
+            row = conn.execute("SELECT content FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            # `created` doubles as the last-used time so eviction is LRU
+            conn.execute("UPDATE cache SET created = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: bytes, context_type: str, content: str):
+        """Store content for a key and evict the least recently used rows."""
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, context_type, content, created) VALUES (?, ?, ?, ?)",
+                    (key, context_type, content, time.time())
+                )
+                conn.execute(
+                    """
+                    DELETE FROM cache
+                    WHERE key NOT IN (
+                        SELECT key FROM cache ORDER BY created DESC LIMIT ?
+                    )
+                    """,
+                    (self.max_rows,)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
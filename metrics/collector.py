@@ -1,37 +1,90 @@
 # metrics/collector.py
+import atexit
+import contextvars
+import logging
+import queue
 import sqlite3
+import threading
 import time
 import json
 from typing import Dict, Any, Optional
 from datetime import datetime
-import tiktoken
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+# Tells the writer thread to exit
+_STOP = object()
+
+# Each asyncio task (or thread) tracks its own interactions, so concurrent agent
+# calls never share or clobber metrics state. Maps a collector's key to its
+# interaction in progress; the dict is replaced rather than mutated because
+# tasks start from a shallow copy of their parent's context.
+_current_interactions: contextvars.ContextVar[Dict[object, Dict[str, Any]]] = (
+    contextvars.ContextVar("metrics_interactions", default={})
+)
 
 class MetricsCollector:
     def __init__(self, model_name: str = "gpt-4o", db_path: str = "metrics.db"):
         """Initialize metrics collector with SQLite storage."""
         self.model_name = model_name
-        self.encoding = tiktoken.encoding_for_model(model_name)
         self.db_path = db_path
         self.session_id = datetime.now().isoformat()
-        self.current_interaction = None
+        # Identifies this collector's entry in _current_interactions
+        self._context_key = object()
+        self._lock = threading.Lock()
+        # One long-lived autocommit connection; transactions are explicit
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA mmap_size=268435456")
         self._init_db()
 
+        # Interaction records are written by a background thread so the caller
+        # never waits on SQLite
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        # prompt/solution/reflection are stored zstd-compressed; this compressor
+        # belongs to this collector's writer thread and is used nowhere else
+        self._compressor = zstandard.ZstdCompressor(level=3)
+        self._writer = threading.Thread(target=self._drain_queue, name="metrics-writer", daemon=True)
+        self._writer.start()
+        self._closed = False
+        # Orders end_interaction's enqueue against close() queuing the stop sentinel
+        self._close_lock = threading.Lock()
+        # Flush queued records even when the owner never calls close()
+        atexit.register(self.close)
+
     def _init_db(self):
         """Initialize SQLite database with necessary tables."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS interactions (
                     id INTEGER PRIMARY KEY,
                     session_id TEXT,
                     timestamp TEXT,
-                    prompt TEXT,
-                    solution TEXT,
-                    reflection TEXT,
+                    prompt BLOB,
+                    solution BLOB,
+                    reflection BLOB,
                     total_tokens INTEGER,
                     response_time REAL,
-                    layers_accessed TEXT
+                    layers_accessed TEXT,
+                    layers_mask INTEGER
                 )
             """)
+            # Older databases only have the JSON column; add the bitmask and backfill it
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(interactions)")}
+            if 'layers_mask' not in columns:
+                conn.execute("ALTER TABLE interactions ADD COLUMN layers_mask INTEGER")
+                conn.execute("""
+                    UPDATE interactions
+                    SET layers_mask = (
+                        SELECT COALESCE(SUM(1 << (value - 1)), 0)
+                        FROM json_each(interactions.layers_accessed)
+                    )
+                """)
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS completions (
                     id INTEGER PRIMARY KEY,
@@ -43,14 +96,35 @@ class MetricsCollector:
                     FOREIGN KEY(interaction_id) REFERENCES interactions(id)
                 )
             """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_interactions_ts ON interactions(timestamp DESC)")
+
+    @property
+    def current_interaction(self) -> Optional[Dict[str, Any]]:
+        """The interaction in progress in the calling task, if any."""
+        return _current_interactions.get().get(self._context_key)
+
+    def _set_interaction(self, interaction: Optional[Dict[str, Any]]):
+        """Replace (or with None, clear) the calling task's interaction."""
+        interactions = dict(_current_interactions.get())
+        if interaction is None:
+            interactions.pop(self._context_key, None)
+        else:
+            interactions[self._context_key] = interaction
+        _current_interactions.set(interactions)
 
     def start_interaction(self):
-        """Start a new interaction."""
-        self.current_interaction = {
+        """Start a new interaction in the calling task."""
+        self._set_interaction({
             'start_time': time.time(),
             'completions': [],
             'layer_access': set(),
-        }
+        })
+
+    def discard_interaction(self) -> Optional[Dict[str, Any]]:
+        """Stop tracking the calling task's interaction without saving it, and return it."""
+        interaction = self.current_interaction
+        self._set_interaction(None)
+        return interaction
 
     def log_layer_access(self, layer: int):
         """Log access to a specific memory layer."""
@@ -69,62 +143,112 @@ class MetricsCollector:
 
     def end_interaction(self, prompt: str, solution: str, reflection: str, layers_accessed: list):
         """End the current interaction and save metrics."""
-        if not self.current_interaction:
+        interaction = self.current_interaction
+        if not interaction:
             return
+        self._set_interaction(None)
 
         end_time = time.time()
-        duration = end_time - self.current_interaction['start_time']
+        duration = end_time - interaction['start_time']
         
-        with sqlite3.connect(self.db_path) as conn:
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'prompt': prompt,
+            'solution': solution,
+            'reflection': reflection,
+            'duration': duration,
+            'layer_access': list(interaction['layer_access']),
+            'completions': interaction['completions'],
+        }
+        with self._close_lock:
+            # No writer drains the queue after close, so a late record would hang flush()
+            if self._closed:
+                logger.warning("Metrics collector is closed, dropping interaction")
+                return
+            self._queue.put(record)
+
+    def _drain_queue(self):
+        """Write queued interaction records until the stop sentinel arrives."""
+        while True:
+            record = self._queue.get()
+            try:
+                if record is _STOP:
+                    return
+                with self._lock:
+                    self._write_interaction(record)
+            except Exception as e:
+                logger.error(f"Failed to record metrics: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _pack(self, text: str) -> bytes:
+        """Compress text for storage in a BLOB column. Writer thread only."""
+        return self._compressor.compress(text.encode('utf-8'))
+
+    def _write_interaction(self, record: Dict[str, Any]):
+        """Insert an interaction record and its completions. Caller holds the lock."""
+        conn = self._conn
+        prompt = record['prompt']
+        solution = record['solution']
+        reflection = record['reflection']
+        try:
+            # One explicit transaction so the whole interaction costs a single commit
+            conn.execute("BEGIN")
             # Insert interaction
             cursor = conn.execute(
                 """
                 INSERT INTO interactions 
                 (session_id, timestamp, prompt, solution, reflection, total_tokens, 
-                 response_time, layers_accessed)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 response_time, layers_accessed, layers_mask)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
                 (
                     self.session_id,
-                    datetime.now().isoformat(),
-                    prompt,
-                    solution,
-                    reflection,
-                    self._count_tokens(prompt + solution + reflection),
-                    duration,
-                    json.dumps(list(self.current_interaction['layer_access']))
+                    record['timestamp'],
+                    self._pack(prompt),
+                    self._pack(solution),
+                    self._pack(reflection),
+                    sum(
+                        completion['prompt_tokens'] + completion['completion_tokens']
+                        for completion in record['completions']
+                    ),
+                    record['duration'],
+                    json.dumps(record['layer_access']),
+                    sum(1 << (layer - 1) for layer in set(record['layer_access']))
                 )
             )
             
             interaction_id = cursor.lastrowid
             
             # Insert completions
-            for completion in self.current_interaction['completions']:
-                conn.execute(
-                    """
-                    INSERT INTO completions 
-                    (interaction_id, context_type, duration, prompt_tokens, completion_tokens)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    (
-                        interaction_id,
-                        completion['context_type'],
-                        completion['duration'],
-                        completion['prompt_tokens'],
-                        completion['completion_tokens']
-                    )
+            rows = [
+                (
+                    interaction_id,
+                    completion['context_type'],
+                    completion['duration'],
+                    completion['prompt_tokens'],
+                    completion['completion_tokens']
                 )
-
-        self.current_interaction = None
-
-    def _count_tokens(self, text: str) -> int:
-        """Count tokens in a string."""
-        return len(self.encoding.encode(text))
+                for completion in record['completions']
+            ]
+            conn.executemany(
+                """
+                INSERT INTO completions 
+                (interaction_id, context_type, duration, prompt_tokens, completion_tokens)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
 
     def get_summary(self) -> Dict[str, Any]:
         """Get summary metrics for the current session."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        self.flush()
+        with self._lock:
+            conn = self._conn
             
             # Get session metrics
             cursor = conn.execute(
@@ -156,4 +280,21 @@ class MetricsCollector:
             layer_patterns = [json.loads(row['layers_accessed']) for row in cursor]
             summary['recent_layer_patterns'] = layer_patterns
             
-            return summary
\ No newline at end of file
+            return summary
+
+    def flush(self):
+        """Block until every queued interaction has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Write any queued interactions, stop the writer and close the database connection."""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        with self._lock:
+            self._conn.close()
@@ -1,49 +1,78 @@
 # metrics/dashboard.py
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import sqlite3
+import os
 from datetime import datetime, timedelta
-import json
 
-def load_data(db_path: str):
-    """Load metrics data from SQLite database."""
+def db_mtime(db_path: str) -> float:
+    """Latest modification time of the database, including its WAL file."""
+    wal_path = db_path + "-wal"
+    mtime = os.path.getmtime(db_path)
+    if os.path.exists(wal_path):
+        mtime = max(mtime, os.path.getmtime(wal_path))
+    return mtime
+
+@st.cache_data(ttl=10, show_spinner=False)
+def load_data(db_path: str, mtime: float):
+    """
+    Load summary aggregates and recent interaction metrics from SQLite.
+
+    `mtime` is only part of the cache key, so new writes invalidate the cache.
+    """
     conn = sqlite3.connect(db_path)
     
-    # Load interactions
-    interactions_df = pd.read_sql_query(
-        """
-        SELECT *
-        FROM interactions
-        ORDER BY timestamp DESC
-        LIMIT 100
-        """,
-        conn
-    )
-    
-    # Load completions
-    completions_df = pd.read_sql_query(
-        """
-        SELECT *
-        FROM completions
-        ORDER BY id DESC
-        LIMIT 100
-        """,
-        conn
-    )
+    try:
+        # Aggregate in SQL rather than pulling rows into pandas
+        cursor = conn.execute(
+            """
+            SELECT 
+                COUNT(*) as total_interactions,
+                AVG(total_tokens) as avg_tokens,
+                AVG(response_time) as avg_response_time
+            FROM interactions
+            """
+        )
+        columns = [col[0] for col in cursor.description]
+        summary = dict(zip(columns, cursor.fetchone()))
+        
+        # Databases the collector has not migrated yet only have the JSON column,
+        # so derive the bitmask from it on the fly
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(interactions)")}
+        if 'layers_mask' in columns:
+            mask_expr = "layers_mask"
+        else:
+            mask_expr = """(
+                SELECT COALESCE(SUM(1 << (value - 1)), 0)
+                FROM json_each(interactions.layers_accessed)
+            ) AS layers_mask"""
+
+        # Load only the small columns the charts need; skip the text blobs
+        recent_df = pd.read_sql_query(
+            f"""
+            SELECT timestamp, total_tokens, response_time, {mask_expr}
+            FROM interactions
+            ORDER BY timestamp DESC
+            LIMIT 100
+            """,
+            conn
+        )
+    finally:
+        conn.close()
     
-    conn.close()
-    return interactions_df, completions_df
+    return summary, recent_df
 
 def create_dashboard(db_path: str = "metrics.db"):
     """Create Streamlit dashboard for metrics visualization."""
     st.title("Coding Agent Metrics Dashboard")
     
     try:
-        interactions_df, completions_df = load_data(db_path)
+        summary, interactions_df = load_data(db_path, db_mtime(db_path))
         
-        if len(interactions_df) == 0:
+        if summary['total_interactions'] == 0:
             st.warning("No metrics data available yet. Run some queries through the agent first.")
             return
         
@@ -52,15 +81,15 @@ def create_dashboard(db_path: str = "metrics.db"):
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            avg_tokens = interactions_df['total_tokens'].mean()
+            avg_tokens = summary['avg_tokens'] or 0
             st.metric("Avg Tokens/Request", f"{int(avg_tokens):,}")
             
         with col2:
-            avg_time = interactions_df['response_time'].mean()
+            avg_time = summary['avg_response_time'] or 0
             st.metric("Avg Response Time", f"{avg_time:.2f}s")
             
         with col3:
-            total_interactions = len(interactions_df)
+            total_interactions = summary['total_interactions']
             st.metric("Total Interactions", total_interactions)
         
         # Token usage over time
@@ -75,11 +104,9 @@ def create_dashboard(db_path: str = "metrics.db"):
         
         # Layer access patterns
         st.header("Layer Access Patterns")
-        layer_patterns = interactions_df['layers_accessed'].apply(json.loads)
-        layer_matrix = pd.DataFrame([
-            [1 if l in pattern else 0 for l in range(1, 5)]
-            for pattern in layer_patterns
-        ])
+        # Bit i of layers_mask is set when layer i + 1 was accessed
+        masks = interactions_df['layers_mask'].fillna(0).to_numpy(dtype=np.uint8)
+        layer_matrix = ((masks[:, None] >> np.arange(4, dtype=np.uint8)) & 1).astype(np.uint8)
         
         fig_layers = px.imshow(
             layer_matrix.T,
@@ -0,0 +1,232 @@
+# metrics/dispatcher.py
+import asyncio
+import functools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import openai
+import tiktoken
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+logger = logging.getLogger(__name__)
+
+# Transient errors worth retrying after a short backoff
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# Loading an encoding may download its BPE table, so do it once per model
+_ENC_CACHE: Dict[str, tiktoken.Encoding] = {}
+
+def get_encoding_for_model(model: str) -> tiktoken.Encoding:
+    """Return the tiktoken encoding for a model, loading it on first use."""
+    encoding = _ENC_CACHE.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        _ENC_CACHE[model] = encoding
+    return encoding
+
+@dataclass
+class _APIRequest:
+    """A queued chat completion request waiting for capacity."""
+    messages: List[Dict[str, str]]
+    context_type: str
+    params: Dict[str, Any]
+    token_consumption: int
+    future: asyncio.Future
+
+class RateLimitedDispatcher:
+    def __init__(
+        self,
+        client: openai.AsyncOpenAI,
+        model: str,
+        max_requests_per_minute: float = 500,
+        max_tokens_per_minute: float = 30000,
+        max_tokens: int = 1024,
+        max_attempts: int = 5,
+        max_concurrency: int = 8,
+        rate_limit_cooldown: float = 15.0,
+    ):
+        """
+        Dispatch chat completions through a bounded worker pool that respects
+        request-per-minute and token-per-minute limits.
+
+        Args:
+            client: The OpenAI client used to issue requests
+            model: The model to request completions from
+            max_requests_per_minute: Request budget refilled continuously
+            max_tokens_per_minute: Token budget refilled continuously
+            max_tokens: Expected completion size when the request sets no max_tokens
+            max_attempts: Attempts per request before giving up on retryable errors
+            max_concurrency: Number of requests allowed in flight at once
+            rate_limit_cooldown: Seconds all workers pause after a rate limit error
+        """
+        self.client = client
+        self.model = model
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.max_tokens = max_tokens
+        self.max_attempts = max_attempts
+        self.max_concurrency = max_concurrency
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self._encoding: Optional[tiktoken.Encoding] = None
+        self._encoding_failed = False
+        # The shared system+memory prefix repeats on every call, so memoize per string
+        self._count_tokens = functools.lru_cache(maxsize=256)(self._encode_length)
+
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self._last_update = time.monotonic()
+        self._last_rate_limit_error = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, messages: List[Dict[str, str]], context_type: str, **params) -> Any:
+        """Queue a chat completion and wait for its response."""
+        self._ensure_workers()
+        future = self._loop.create_future()
+        await self._queue.put(_APIRequest(
+            messages=messages,
+            context_type=context_type,
+            params=params,
+            token_consumption=self._estimate_tokens(messages, params),
+            future=future
+        ))
+        return await future
+
+    async def aclose(self):
+        """Stop the worker pool."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        self._loop = None
+
+    def _ensure_workers(self):
+        """Start the worker pool on the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._workers = [
+            loop.create_task(self._worker()) for _ in range(self.max_concurrency)
+        ]
+
+    async def _worker(self):
+        """Pull requests off the queue and issue them once capacity allows."""
+        while True:
+            request = await self._queue.get()
+            try:
+                if request.future.cancelled():
+                    continue
+                response = await self._call_with_retries(request)
+                if not request.future.done():
+                    request.future.set_result(response)
+            except asyncio.CancelledError:
+                if not request.future.done():
+                    request.future.cancel()
+                raise
+            except Exception as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _call_with_retries(self, request: _APIRequest) -> Any:
+        """Issue a request, backing off exponentially with jitter on transient errors."""
+        def before_sleep(retry_state: RetryCallState):
+            error = retry_state.outcome.exception()
+            if isinstance(error, openai.RateLimitError):
+                self._last_rate_limit_error = time.monotonic()
+            logger.warning(
+                f"{request.context_type} request failed ({error.__class__.__name__}: {error}), "
+                f"retrying in {retry_state.next_action.sleep:.1f}s "
+                f"(attempt {retry_state.attempt_number}/{self.max_attempts})"
+            )
+
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=wait_random_exponential(min=1, max=30),
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            before_sleep=before_sleep,
+            reraise=True
+        ):
+            with attempt:
+                # Every attempt, including retries, spends rate limit capacity
+                await self._acquire_capacity(request.token_consumption)
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=request.messages,
+                    **request.params
+                )
+        return response
+
+    async def _acquire_capacity(self, token_consumption: int):
+        """Wait until the request and token budgets can cover one more request."""
+        while True:
+            cooldown_left = self._last_rate_limit_error + self.rate_limit_cooldown - time.monotonic()
+            if cooldown_left > 0:
+                await asyncio.sleep(cooldown_left)
+                continue
+
+            self._refill_capacity()
+            if (self.available_request_capacity >= 1
+                    and self.available_token_capacity >= token_consumption):
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= token_consumption
+                return
+            await asyncio.sleep(0.05)
+
+    def _refill_capacity(self):
+        """Top up both budgets in proportion to the time since the last refill."""
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60.0,
+            self.max_requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60.0,
+            self.max_tokens_per_minute
+        )
+
+    def _encode_length(self, text: str) -> int:
+        """Count tokens in a string, falling back to ~4 characters per token."""
+        if self._encoding is None and not self._encoding_failed:
+            try:
+                self._encoding = get_encoding_for_model(self.model)
+            except Exception as e:
+                logger.warning(f"Could not load tokenizer for {self.model}, estimating by length: {e}")
+                self._encoding_failed = True
+        if self._encoding is None:
+            return len(text) // 4 + 1
+        return len(self._encoding.encode(text))
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]], params: Dict[str, Any]) -> int:
+        """Estimate prompt plus completion tokens for a chat request."""
+        num_tokens = 2  # every reply is primed with <im_start>assistant
+        for message in messages:
+            num_tokens += 4  # <im_start>{role/name}\n{content}<im_end>\n
+            for value in message.values():
+                num_tokens += self._count_tokens(value)
+        completion_tokens = params.get("max_tokens") or self.max_tokens
+        # Never wait for more capacity than the bucket can ever hold
+        return min(num_tokens + params.get("n", 1) * completion_tokens,
+                   int(self.max_tokens_per_minute))